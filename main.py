@@ -1,12 +1,26 @@
-from dotenv import load_dotenv
+from __future__ import annotations
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import Response
 from functions_framework import logging
-from github import Github
-from jira import JIRA
+from requests.adapters import HTTPAdapter
+from typing import TYPE_CHECKING
+from urllib3.util.retry import Retry
 import functions_framework
+import functools
 import hashlib
 import hmac
+import orjson
 import os
-import regex
+import re
+import requests
+import threading
+import time
+
+# jira is only imported when needed (not for rejected webhooks): it
+# weighs on the cloud function cold start
+if TYPE_CHECKING:
+    from jira import JIRA
 
 # Setup logger
 log = logging.getLogger(__name__)
@@ -16,6 +30,82 @@ logging.basicConfig(
 )
 
 
+# "Official" Jira issue regexp, adapted for python
+# re module only handles fixed-width lookbehinds: the start of the string
+# is checked outside of the lookbehind
+_JIRA_ISSUE_RE = re.compile(
+    r"(?:^|(?<=[ _-]))([0-9A-Z][A-Za-z]{1,10}-[0-9]+)(?=[ _-]|$)", flags=re.ASCII
+)
+
+# Commit & repository of the payload, checked before being used in the
+# Github API url ("." & ".." are not proper owner / repository names)
+_COMMIT_SHA_RE = re.compile(r"[0-9a-fA-F]{40}")
+_REPOSITORY_NAME_RE = re.compile(
+    r"(?!\.{1,2}/)[\w.-]+/(?!\.{1,2}$)[\w.-]+", flags=re.ASCII
+)
+
+# Timeout (in seconds) of the calls to Jira & Github APIs
+_HTTP_TIMEOUT = 5
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter applying a default timeout to the requests it sends
+    (the jira library does not apply the timeout it is given)
+    """
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = _HTTP_TIMEOUT
+        return super().send(request, **kwargs)
+
+
+# Adapter shared by the Jira & Github sessions: transient errors of the
+# APIs are retried with a backoff, the last response is returned as is.
+# POST is retried as well: creating a commit status (the only POST sent)
+# is idempotent for a given commit sha & context
+_HTTP_ADAPTER = _TimeoutHTTPAdapter(
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+        raise_on_status=False,
+    ),
+    pool_connections=4,
+    pool_maxsize=10,
+)
+
+# Clients are kept at module level so that warm instances reuse their
+# underlying HTTP sessions (and connection pools) across invocations
+_JIRA_CLIENTS: dict[tuple, JIRA] = {}
+_JIRA_CLIENTS_LOCK = threading.Lock()
+_GITHUB_API_URL = "https://api.github.com"
+_GITHUB_SESSION = requests.Session()
+_GITHUB_SESSION.mount("https://", _HTTP_ADAPTER)
+
+# Github commit statuses sent in the background (when configured so), once
+# the webhook has been answered. Kept small: Github API rate limits the
+# status creation
+_GITHUB_STATUS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="github-status"
+)
+
+# Jira project keys, per Jira domain, with the (monotonic) time of the
+# lookup: issue ids of unknown projects are not looked up in Jira
+_JIRA_PROJECT_KEYS_TTL = 600
+_JIRA_PROJECT_KEYS: dict[str, tuple[set[str] | None, float]] = {}
+_JIRA_PROJECT_KEYS_LOCK = threading.Lock()
+_JIRA_PROJECT_KEYS_REFRESHING: set[str] = set()
+
+# Jira issues already found, with the (monotonic) time of the lookup.
+# Only found issues are cached: a miss is always checked against Jira again
+_JIRA_ISSUES_CACHE_SIZE = 1024
+_JIRA_ISSUES_CACHE_TTL = 300
+_JIRA_ISSUES: OrderedDict[tuple, float] = OrderedDict()
+_JIRA_ISSUES_LOCK = threading.Lock()
+
+
 class NotJiraIssueException(Exception):
     """
     Raised when a Github branch is not referenced as a Jira issue
@@ -28,34 +118,42 @@ class WebhookNotAuthorizedException(Exception):
     """
 
 
-def check_payload_secret(request: object, config: dict) -> bool:
+class JiraLookupException(Exception):
+    """
+    Raised when Jira can not be queried (authentication, network...)
+    """
+
+
+def check_payload_secret(
+    payload: bytes, github_hash: str | None, github_webhook_secret: bytes | None
+) -> bool:
     """
     Check the payload send if the configuration contains a webhook secret
     See :
     - https://docs.github.com/en/developers/webhooks-and-events/webhooks/securing-your-webhooks
     """
 
-    result = None
-
-    github_hash = request.headers.get("X-Hub-Signature-256")
-    # Fetch the request for the hash
-    if github_hash is None:
-        result = False
-
-    github_webhook_secret = config["github_webhook_secret"]
     if github_webhook_secret is None:
         # no secret provided: no check needed
-        result = True
-    else:
-        signature = hmac.new(
-            key=bytes(github_webhook_secret, "latin-1"),
-            digestmod=hashlib.sha256,
-            msg=request.get_data(),
-        ).hexdigest()
-        # Check if the transmitted sha256 matches the hash of the content
-        # with the webhook's secret
-        result = ("sha256=" + signature) == github_hash
-        log.debug("check of the SHA256 of the message: %s", result)
+        return True
+
+    # Reject a missing or malformed hash before hashing the content:
+    # expecting "sha256=" followed by 64 hex digits
+    if (
+        github_hash is None
+        or len(github_hash) != 71
+        or not github_hash.isascii()
+        or not github_hash.startswith("sha256=")
+    ):
+        log.debug("malformed or missing SHA256 of the message")
+        return False
+
+    signature = hmac.new(key=github_webhook_secret, digestmod=hashlib.sha256)
+    signature.update(payload)
+    # Check if the transmitted sha256 matches the hash of the content
+    # with the webhook's secret (constant time comparison)
+    result = hmac.compare_digest("sha256=" + signature.hexdigest(), github_hash)
+    log.debug("check of the SHA256 of the message: %s", result)
     return result
 
 
@@ -74,15 +172,103 @@ def get_payload_type(payload: str) -> str | None:
 def get_jira_issue_from_branch_name(branch_name: str) -> str:
     """
     Extract the Jira issue from the branch name
-    Uses the "official" Jira regexp, adapted for python
-    re module does not manage properly lookahead : using regex instead
     """
-    match = regex.findall(
-        r"(?<= |-|_|^)([0-9A-Z][A-Za-z]{1,10}-[0-9]+)(?= |-|_|$)",
-        branch_name,
-    )
-    # Search for the first issue found in the commit message
-    return match[0] if len(match) > 0 else None
+    # Cheap rejection of the branch names that cannot contain an issue id
+    # (main, feature/xxx, ...) before using the regexp
+    if "-" not in branch_name or not any(c.isdigit() for c in branch_name):
+        return None
+    # Search for the first issue found in the branch name
+    match = _JIRA_ISSUE_RE.search(branch_name)
+    return match.group(1) if match is not None else None
+
+
+def _get_jira_client(config: dict) -> JIRA:
+    """
+    Return a Jira client for the configured server & credentials,
+    creating it on first use only
+    """
+    key = (config["jira_domain"], config["jira_email"], config["jira_token"])
+    with _JIRA_CLIENTS_LOCK:
+        jira = _JIRA_CLIENTS.get(key)
+        if jira is None:
+            from jira import JIRA
+
+            # No server info fetched at creation: not needed for
+            # looking up issues & projects. Retries are left to the adapter
+            jira = JIRA(
+                server=config["jira_server_url"],
+                basic_auth=(config["jira_email"], config["jira_token"]),
+                options={"verify": True},
+                get_server_info=False,
+                max_retries=0,
+                timeout=_HTTP_TIMEOUT,
+            )
+            jira._session.mount("https://", _HTTP_ADAPTER)
+            _JIRA_CLIENTS[key] = jira
+    return jira
+
+
+def _is_cached_jira_issue(key: tuple) -> bool:
+    """
+    Check if the issue has been found in Jira recently
+    """
+    with _JIRA_ISSUES_LOCK:
+        found_at = _JIRA_ISSUES.get(key)
+        if found_at is None:
+            return False
+        if time.monotonic() - found_at > _JIRA_ISSUES_CACHE_TTL:
+            del _JIRA_ISSUES[key]
+            return False
+        _JIRA_ISSUES.move_to_end(key)
+        return True
+
+
+def _cache_jira_issue(key: tuple) -> None:
+    """
+    Remember an issue found in Jira, evicting the least recently used ones
+    """
+    with _JIRA_ISSUES_LOCK:
+        _JIRA_ISSUES[key] = time.monotonic()
+        _JIRA_ISSUES.move_to_end(key)
+        while len(_JIRA_ISSUES) > _JIRA_ISSUES_CACHE_SIZE:
+            _JIRA_ISSUES.popitem(last=False)
+
+
+def _get_jira_project_keys(config: dict) -> set[str] | None:
+    """
+    Return the keys of the Jira projects visible with the configured token,
+    refreshed every few minutes.
+    None is returned when the projects can not be listed.
+    The projects are listed outside of the lock: while a refresh is in
+    progress, the previous keys (if any) are returned to the other threads.
+    """
+    domain = config["jira_domain"]
+    with _JIRA_PROJECT_KEYS_LOCK:
+        cached = _JIRA_PROJECT_KEYS.get(domain)
+        if (
+            cached is not None
+            and time.monotonic() - cached[1] <= _JIRA_PROJECT_KEYS_TTL
+        ):
+            return cached[0]
+        if domain in _JIRA_PROJECT_KEYS_REFRESHING:
+            return cached[0] if cached is not None else None
+        _JIRA_PROJECT_KEYS_REFRESHING.add(domain)
+
+    project_keys = None
+    try:
+        project_keys = {project.key for project in _get_jira_client(config).projects()}
+        log.debug("%d Jira projects found", len(project_keys))
+    except Exception as e:
+        log.debug("failed to list Jira projects: %s", e)
+    finally:
+        if not project_keys:
+            # Jira unreachable, or probably no "browse projects" permission
+            # for the token: no check on the project keys until the next refresh
+            project_keys = None
+        with _JIRA_PROJECT_KEYS_LOCK:
+            _JIRA_PROJECT_KEYS[domain] = (project_keys, time.monotonic())
+            _JIRA_PROJECT_KEYS_REFRESHING.discard(domain)
+    return project_keys
 
 
 def is_jira_issue(config: dict, issue_id: str) -> bool:
@@ -91,40 +277,81 @@ def is_jira_issue(config: dict, issue_id: str) -> bool:
     querying Jira API.
     Beware that the visibility of the issue depends of the rights
     of the token provided in the config dict.
+    Found issues are cached for a few minutes.
+    When enabled in the config dict, issue ids of projects unknown to Jira
+    are rejected without looking up the issue.
+    Jira errors other than "issue not found" (authentication, network...)
+    are raised as a JiraLookupException, with a short message: the details
+    (Jira response, headers...) are only logged.
     """
-    result = True
+    cache_key = (config["jira_domain"], issue_id)
+    if _is_cached_jira_issue(cache_key):
+        log.debug("%s found in cache", issue_id)
+        return True
+
+    if config["jira_check_project_keys"]:
+        project_keys = _get_jira_project_keys(config)
+        project_key = issue_id.split("-", 1)[0].upper()
+        if project_keys is not None and project_key not in project_keys:
+            log.debug("project %s not found in Jira", project_key)
+            return False
+
+    from jira.exceptions import JIRAError
+
+    jira = _get_jira_client(config)
+    log.debug("looking of issue '%s' in Jira..", issue_id)
     try:
-        jira = JIRA(
-            server="https://" + config["jira_domain"],
-            basic_auth=(config["jira_email"], config["jira_token"]),
-        )
-        log.debug("looking of issue '%s' in Jira..", issue_id)
         # will trigger an exception when the issue is not found
         jira.issue(issue_id)
-        log.debug("%s found in Jira", issue_id)
-    except Exception as e:
-        log.debug(e)
-        result = False
-    return result
+    except JIRAError as e:
+        if e.status_code == 404:
+            return False
+        log.error("Jira lookup of issue %s failed: %s", issue_id, e)
+        raise JiraLookupException(
+            f"Jira lookup failed (HTTP {e.status_code})"
+        ) from None
+    except requests.RequestException as e:
+        log.error("Jira lookup of issue %s failed: %s", issue_id, e)
+        raise JiraLookupException(f"Jira lookup failed ({type(e).__name__})") from None
+    log.debug("%s found in Jira", issue_id)
+    _cache_jira_issue(cache_key)
+    return True
 
 
 def get_branch_name_from_ref(git_ref: str) -> str | None:
     """
-    Regexp for extracting the branch name from a git ref
+    Extract the branch name from a git ref
     """
-    branch_name_re = "^refs/heads/(.*)$"
-    match = regex.match(branch_name_re, git_ref)
-    return match[1] if match is not None else match
+    prefix = "refs/heads/"
+    return git_ref[len(prefix) :] if git_ref.startswith(prefix) else None
 
 
 def get_config() -> dict:
     """
     Wrapper to fetch the configuration from env vars
+    The configuration is loaded once per instance: the returned dict
+    is shared and must not be modified
+    """
+    return _load_config()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_config() -> dict:
+    """
+    Fetch the configuration from env vars
     """
     # Load the local dotenv, if present (for dev env mostly)
-    load_dotenv(dotenv_path="dev/.env")
+    if os.path.exists("dev/.env"):
+        from dotenv import load_dotenv
+
+        load_dotenv(dotenv_path="dev/.env")
     config = {}
     config["jira_domain"] = os.getenv("JIRA_DOMAIN")
+    config["jira_server_url"] = (
+        "https://" + config["jira_domain"]
+        if config["jira_domain"] is not None
+        else None
+    )
     config["log_level"] = (
         int(os.getenv("LOG_LEVEL"))
         if os.getenv("LOG_LEVEL") is not None
@@ -132,9 +359,23 @@ def get_config() -> dict:
     )
     config["jira_email"] = os.getenv("JIRA_EMAIL")
     config["jira_token"] = os.getenv("JIRA_TOKEN")
+    config["jira_check_project_keys"] = os.getenv(
+        "JIRA_CHECK_PROJECT_KEYS", "false"
+    ).lower() in ("true", "1")
     config["github_token"] = os.getenv("GITHUB_TOKEN")
     config["github_webhook_secret"] = os.getenv("GITHUB_WEBHOOK_SECRET")
+    # Key of the payload signature, encoded once
+    config["github_webhook_secret_bytes"] = (
+        config["github_webhook_secret"].encode("latin-1")
+        if config["github_webhook_secret"] is not None
+        else None
+    )
     config["callback_url"] = os.getenv("CALLBACK_URL")
+    # Only for "CPU always allocated" deployments: the CPU is throttled
+    # once the response is sent otherwise
+    config["github_status_async"] = os.getenv(
+        "GITHUB_STATUS_ASYNC", "false"
+    ).lower() in ("true", "1")
     return config
 
 
@@ -144,19 +385,42 @@ def push_github_commit_status(commit_status: dict) -> bool:
     These checks are used by PR when Github is properly configured
     See:
     -  https://docs.github.com/en/pull-requests/collaborating-with-pull-requests/collaborating-on-repositories-with-code-quality-features/about-status-checks
+    -  https://docs.github.com/en/rest/commits/statuses#create-a-commit-status
     """
-    g = Github(commit_status["github_token"])
-    repo = g.get_repo(commit_status["repository_name"])
-    log.debug("get github repo %s", repo)
-    commit = repo.get_commit(sha=commit_status["commit_sha"])
-    log.debug("get github commit %s", commit)
-
-    commit.create_status(
-        state=commit_status["status"],
-        target_url=commit_status["callback_url"],
-        description=commit_status["message"],
-        context="branch-name/jira",
+    commit_sha = commit_status["commit_sha"]
+    repository_name = commit_status["repository_name"]
+    if commit_sha is None or repository_name is None:
+        # payload not parsed: no commit to send the status to
+        log.info("commit or repository unknown: no github commit status sent")
+        return
+    # both come from the payload & end up in the Github API url
+    if not isinstance(commit_sha, str) or not _COMMIT_SHA_RE.fullmatch(commit_sha):
+        log.error("invalid commit sha: no github commit status sent")
+        return
+    if not isinstance(repository_name, str) or not _REPOSITORY_NAME_RE.fullmatch(
+        repository_name
+    ):
+        log.error("invalid repository name: no github commit status sent")
+        return
+
+    status = {
+        "state": commit_status["status"],
+        "description": commit_status["message"],
+        "context": "branch-name/jira",
+    }
+    if commit_status["callback_url"] is not None:
+        status["target_url"] = commit_status["callback_url"]
+
+    response = _GITHUB_SESSION.post(
+        f"{_GITHUB_API_URL}/repos/{repository_name}/statuses/{commit_sha}",
+        json=status,
+        headers={
+            "Authorization": f"Bearer {commit_status['github_token']}",
+            "Accept": "application/vnd.github+json",
+        },
+        timeout=_HTTP_TIMEOUT,
     )
+    response.raise_for_status()
     log.debug(
         "send commit status %s for commit sha %s in project %s",
         commit_status["status"],
@@ -165,6 +429,22 @@ def push_github_commit_status(commit_status: dict) -> bool:
     )
 
 
+def _json_response(body: dict, status: int) -> Response:
+    """
+    Build a JSON response, serialized with orjson
+    """
+    return Response(orjson.dumps(body), status=status, mimetype="application/json")
+
+
+def _log_github_commit_status_error(future: Future) -> None:
+    """
+    Log the error raised while sending a Github commit status, if any
+    """
+    error = future.exception()
+    if error is not None:
+        log.error("failed to send github commit status: %s", error)
+
+
 # Main HTTP cloud function (wraps by flask)
 # Name: jira_github_pr_check
 @functions_framework.http
@@ -190,13 +470,20 @@ def jira_github_pr_check(request):
     log.setLevel(config["log_level"])
 
     try:
+        # The body is read once: used for both the secret check & the parsing
+        raw_payload = request.get_data(cache=False)
+
         # Check if github webhook's secret is OK
-        if not check_payload_secret(config=config, request=request):
+        if not check_payload_secret(
+            payload=raw_payload,
+            github_hash=request.headers.get("X-Hub-Signature-256"),
+            github_webhook_secret=config["github_webhook_secret_bytes"],
+        ):
             raise WebhookNotAuthorizedException("webhook secret do not match")
 
         # Payload MUST be send as a JSON application/json content
         # => beware of the configuration of the Webhook in Github
-        payload = request.get_json()
+        payload = orjson.loads(raw_payload)
         payload_type = get_payload_type(payload)
         if payload_type != "pull_request":
             raise ValueError(
@@ -250,6 +537,14 @@ def jira_github_pr_check(request):
         log.error(error_message)
         result = {"message": error_message}
         send_http_code = 403
+    except JiraLookupException as e:
+        # Jira could not be queried: not an issue of the payload
+        error_message = str(e)
+        github_commit_status["message"] = error_message
+
+        log.error(error_message)
+        result = {"message": error_message}
+        send_http_code = 502
     except NotJiraIssueException as e:
         # That was not a proper jira issue :(
         error_message = str(e)
@@ -268,13 +563,20 @@ def jira_github_pr_check(request):
         result = {"message": error_message}
         send_http_code = 400
 
-    try:
-        # Send github commit status if error not 403
-        if send_http_code != 403:
+    # Send github commit status if error not 403
+    if send_http_code != 403 and config["github_status_async"]:
+        # in the background: the webhook does not wait for Github API
+        _GITHUB_STATUS_EXECUTOR.submit(
+            push_github_commit_status, github_commit_status
+        ).add_done_callback(_log_github_commit_status_error)
+    elif send_http_code != 403:
+        try:
             push_github_commit_status(github_commit_status)
-    except Exception as e:
-        log.error(e)
-        result = {"message": str(e)}
-        send_http_code = 500
+        except Exception as e:
+            log.error("failed to send github commit status: %s", e)
+            result = {"message": str(e)}
+            send_http_code = 500
 
+    if isinstance(result, dict):
+        return _json_response(result, send_http_code)
     return result, send_http_code